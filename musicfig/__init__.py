@@ -3,6 +3,7 @@ import os
 import logging
 
 from .database import db
+from .dispatcher import dispatcher, TagAddedEvent, TagRemovedEvent
 from .main import MainLoop
 from .plugins import spotify_client, \
                      webhook_plugin, \
@@ -13,7 +14,7 @@ from flask import Flask, render_template
 from flask_socketio import SocketIO
 from flask_sqlalchemy import SQLAlchemy
 from logging.config import dictConfig
-from pubsub import pub
+from sqlalchemy.pool import QueuePool
 from threading import Thread
 
 dictConfig({
@@ -85,10 +86,10 @@ from . import models
 #from . import events
 
 def l(tag_event, nfc_tag):
-    logger.info("%s, %s", tag_event, nfc_tag)
+    logger.debug("%s, %s", tag_event, nfc_tag)
 
-pub.subscribe(l, 'tag.added')
-pub.subscribe(l, 'tag.removed')
+dispatcher.subscribe(TagAddedEvent, l)
+dispatcher.subscribe(TagRemovedEvent, l)
 
 def init_app():
     app = Flask(__name__,
@@ -96,9 +97,20 @@ def init_app():
                 static_folder='templates')
     app.config.from_object('config')
 
+    # keep a small pool of sqlite connections around for reuse rather than opening
+    # (and re-running the connection PRAGMAs on) a fresh one for every session. The
+    # pool is shared between the pad loop and the web threads, hence check_same_thread
+    database_uri = app.config.get("SQLALCHEMY_DATABASE_URI") or ""
+    if database_uri.startswith("sqlite") and database_uri not in ("sqlite://", "sqlite:///:memory:"):
+        app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {
+            "poolclass": QueuePool,
+            "pool_size": 5,
+            "max_overflow": 0,
+            "connect_args": {"check_same_thread": False},
+        })
+
     db.init_app(app)
     socketio.init_app(app)
-    lego_thread.init_app(app)
 
     # Initializes all of the plugins. Any registration of models, attaching
     # of listeners, etc. should be done within each plugins' `init_app()`
@@ -114,6 +126,14 @@ def init_app():
         app.register_blueprint(web_blueprint)
 
         db.create_all()
+        # create_all skips tables which already exist, so indexes added since the
+        # database was first made need creating separately
+        for index in models.NFCTagModel.__table__.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+        # the tag manager loads and builds every known tag up front, so this has to
+        # wait until the plugins have registered their tag types and the tables exist
+        lego_thread.init_app(app)
         lego_thread.daemon = True
         lego_thread.start()
 
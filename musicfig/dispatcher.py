@@ -0,0 +1,112 @@
+"""
+In-process event dispatch between the pad loop, the plugins, and the web app.
+
+Events are small namedtuples, and listeners subscribe to the event class itself
+rather than to a topic string, so publishing an event is a single dict lookup
+followed by a walk of the listeners for that class.
+
+Listeners are called with the event's fields as positional arguments, in the
+order the fields are declared; e.g. a listener for TagAddedEvent is called as
+`listener(tag_event, nfc_tag)`.
+"""
+from collections import namedtuple
+
+""" A tag was placed on a pad """
+TagAddedEvent = namedtuple("TagAddedEvent", ["tag_event", "nfc_tag"])
+
+""" A tag was taken off a pad """
+TagRemovedEvent = namedtuple("TagRemovedEvent", ["tag_event", "nfc_tag"])
+
+""" A plugin has begun handling a tag event """
+ProcessingStartedEvent = namedtuple("ProcessingStartedEvent", ["tag_event", "color"])
+
+""" A plugin finished handling a tag being added """
+AddSuccessEvent = namedtuple("AddSuccessEvent", ["tag_event", "color"])
+
+""" A plugin failed handling a tag being added """
+AddErrorEvent = namedtuple("AddErrorEvent", ["tag_event"])
+
+""" A plugin finished handling a tag being removed """
+RemoveSuccessEvent = namedtuple("RemoveSuccessEvent", ["tag_event"])
+
+""" A plugin failed handling a tag being removed """
+RemoveErrorEvent = namedtuple("RemoveErrorEvent", ["tag_event"])
+
+""" A new tag was registered through the web app """
+TagCreatedEvent = namedtuple("TagCreatedEvent", [])
+
+
+class EventDispatcher():
+    """
+    Maps event classes to the listeners subscribed to them
+
+    Listeners to events which carry an `nfc_tag` may also subscribe for a single tag
+    class, in which case they're only called for tags of that class (or a subclass
+    of it). The listeners for each (event class, tag class) pair are worked out the
+    first time that pair is published and reused after that, so publishing never
+    has to check each listener against the tag.
+    """
+    def __init__(self):
+        self._listeners_by_type = {}
+        self._resolved_listeners = {}
+
+    def subscribe(self, event_type, listener, tag_class=None):
+        """
+        Registers a listener to be called whenever an event of the given type is published
+
+        Positional arguments:
+        event_type -- the event class to listen for
+        listener -- callable taking the event's fields as positional arguments
+
+        Keyword arguments:
+        tag_class -- if given, only call the listener for events whose nfc_tag is of this class
+        """
+        self._listeners_by_type.setdefault(event_type, {}).setdefault(tag_class, []).append(listener)
+        self._resolved_listeners.clear()
+
+    def unsubscribe(self, event_type, listener, tag_class=None):
+        """
+        Removes a previously subscribed listener; does nothing if it isn't subscribed
+
+        Positional arguments:
+        event_type -- the event class the listener was subscribed to
+        listener -- the listener to remove
+
+        Keyword arguments:
+        tag_class -- the tag class the listener was subscribed with, if any
+        """
+        listeners = self._listeners_by_type.get(event_type, {}).get(tag_class)
+        if listeners is not None and listener in listeners:
+            listeners.remove(listener)
+            self._resolved_listeners.clear()
+
+    def publish(self, event):
+        """
+        Calls every listener subscribed to the type of the given event
+
+        Positional arguments:
+        event -- one of the event namedtuples defined in this module
+        """
+        key = (type(event), type(getattr(event, "nfc_tag", None)))
+        listeners = self._resolved_listeners.get(key)
+        if listeners is None:
+            listeners = self._resolved_listeners[key] = self._resolve_listeners(*key)
+        for listener in listeners:
+            listener(*event)
+
+    def _resolve_listeners(self, event_type, tag_class):
+        """
+        Collects the listeners for an event type which apply to the given tag class
+
+        Positional arguments:
+        event_type -- the event class being published
+        tag_class -- the class of the event's nfc_tag (NoneType if it has none)
+        """
+        listeners_by_tag_class = self._listeners_by_type.get(event_type, {})
+        listeners = list(listeners_by_tag_class.get(None, ()))
+        for ancestor in tag_class.__mro__:
+            listeners.extend(listeners_by_tag_class.get(ancestor, ()))
+        return tuple(listeners)
+
+
+dispatcher = EventDispatcher()
@@ -1,12 +1,14 @@
+import queue
 import random
 import threading
 import time
 
 
 from . import colors
+from .dispatcher import dispatcher, TagAddedEvent, TagRemovedEvent, AddErrorEvent, AddSuccessEvent, \
+                        RemoveSuccessEvent, RemoveErrorEvent, ProcessingStartedEvent, TagCreatedEvent
 from .lego import Dimensions, FakeDimensions, DimensionsTagEvent
 from .nfc_tag import NFCTagManager, NFCTag, NFCTagOperationError
-from pubsub import pub
 from usb.core import USBError
 
 class MainLoop(threading.Thread):
@@ -25,6 +27,9 @@ class MainLoop(threading.Thread):
         self.current_active_tags = set() # this may be better in the Dimensions
         self.do_loop = True
         self.error_count = 0
+        # (handler, args) for pad changes asked for by other threads; applied by this loop
+        # so only one thread ever talks to the pad
+        self._pad_updates = queue.SimpleQueue()
 
     def init_app(self, app):
         """
@@ -38,6 +43,11 @@ class MainLoop(threading.Thread):
         self.app = app
         self.logger = app.logger
         self.dimensions = None
+        self.use_mock_pad = app.config.get("USE_MOCK_PAD")
+        self.idle_color = app.config.get("DEFAULT_IDLE_COLOR", colors.DIM)
+        self.error_color = app.config.get("DEFAULT_ERROR_COLOR", colors.RED)
+        self.default_active_color = app.config.get("DEFAULT_ACTIVE_COLOR", colors.BLUE)
+        self.thinking_color = app.config.get("DEFAULT_THINKING_COLOR", colors.PURPLE)
         with app.app_context():
             # @todo make this configurable somehow
             self.nfc_tag_manager = NFCTagManager.get_instance() # maybe turn this into an init_app() as well
@@ -46,18 +56,55 @@ class MainLoop(threading.Thread):
         self._init_event_handlers()
     
     def _init_event_handlers(self):
-        """ Sets up the event handlers """
-        pub.subscribe(self.on_tag_added_error, "handler_response.add.error")
-        pub.subscribe(self.on_tag_added_success, "handler_response.add.success")
-        pub.subscribe(self.on_tag_removed_success, "handler_response.remove.success")
-        pub.subscribe(self.on_tag_removed_error, "handler_response.remove.error")
-        pub.subscribe(self.on_tag_being_processed, "handler_response.processing_started")
-        pub.subscribe(self.on_tag_created, "tag_created")
-    
+        """
+        Sets up the event handlers
+
+        These events can be published from any thread (plugins finish their work on their
+        own workers, and tags get created from the web app). Ones published from the pad
+        loop are handled straight away; the rest are queued up for the pad loop, which runs
+        them in between reading from the pad.
+        """
+        dispatcher.subscribe(AddErrorEvent, self._queue_pad_update(self.on_tag_added_error))
+        dispatcher.subscribe(AddSuccessEvent, self._queue_pad_update(self.on_tag_added_success))
+        dispatcher.subscribe(RemoveSuccessEvent, self._queue_pad_update(self.on_tag_removed_success))
+        dispatcher.subscribe(RemoveErrorEvent, self._queue_pad_update(self.on_tag_removed_error))
+        dispatcher.subscribe(ProcessingStartedEvent, self._queue_pad_update(self.on_tag_being_processed))
+        dispatcher.subscribe(TagCreatedEvent, self._queue_pad_update(self.on_tag_created))
+
+    def _queue_pad_update(self, handler):
+        """
+        Wraps an event handler so calling it from any thread but the pad loop queues it up
+        for the pad loop instead
+
+        Positional arguments:
+        handler -- the event handler to wrap
+        """
+        def queue_update(*args):
+            if threading.current_thread() is self:
+                handler(*args)
+            else:
+                self._pad_updates.put((handler, args))
+        return queue_update
+
+    def _apply_pad_updates(self):
+        """ Runs the event handlers which have been queued up since the last time """
+        while self.dimensions is not None:
+            try:
+                handler, args = self._pad_updates.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                handler(*args)
+            except Exception as e:
+                self.logger.exception("failed updating the pad for %s", handler.__name__)
+
     def _try_to_connect(self):
         try:
-            self.dimensions = FakeDimensions(self.app) if self.app.config.get("USE_MOCK_PAD") else Dimensions(self.app)
+            self.dimensions = FakeDimensions(self.app) if self.use_mock_pad else Dimensions(self.app)
             self.logger.info("Pad discovered; initializing now")
+            # anything queued up while there was no pad was meant for the pad's old state
+            while not self._pad_updates.empty():
+                self._pad_updates.get_nowait()
             self.dimensions.change_pad_color(Dimensions.ALL_PAD, self.get_idle_color())
         except Exception as e:
             self.logger.warning("Failed to find dimensions pad")
@@ -66,6 +113,8 @@ class MainLoop(threading.Thread):
     def _do_app_logic(self):
         if random.randint(1, 10000) == 0:
             self.logger.info("loop")
+
+        self._apply_pad_updates()
         
         try:
             tag_event = self.dimensions.get_tag_event()
@@ -94,6 +143,9 @@ class MainLoop(threading.Thread):
             self.logger.exception("encountered exception trying to do tag stuff")
             self.error_flash(tag_event.pad_num)
 
+        # the plugins have normally asked for a pad color by now; no need to wait for the next read
+        self._apply_pad_updates()
+
     def run(self):
         """
         Main loop of the program
@@ -117,8 +169,8 @@ class MainLoop(threading.Thread):
         tag_event -- DimensionsTagEvent containing details about the event
         nfc_tag -- the tag which triggered the event
         """
-        topic = "tag.removed" if tag_event.was_removed else "tag.added"
-        pub.sendMessage(topic, tag_event=tag_event, nfc_tag=nfc_tag)
+        event_type = TagRemovedEvent if tag_event.was_removed else TagAddedEvent
+        dispatcher.publish(event_type(tag_event, nfc_tag))
 
     def update_active_tags(self, tag_event: DimensionsTagEvent, nfc_tag: NFCTag):
         """
@@ -211,13 +263,13 @@ class MainLoop(threading.Thread):
     # Color handling
     ###############################
     def get_idle_color(self):
-        return self.app.config.get("DEFAULT_IDLE_COLOR", colors.DIM)
+        return self.idle_color
     
     def get_error_color(self):
-        return self.app.config.get("DEFAULT_ERROR_COLOR", colors.RED)
+        return self.error_color
     
     def get_default_active_color(self):
-        return self.app.config.get("DEFAULT_ACTIVE_COLOR", colors.BLUE)
+        return self.default_active_color
     
     def get_thinking_color(self):
-        return self.app.config.get("DEFAULT_THINKING_COLOR", colors.PURPLE)
\ No newline at end of file
+        return self.thinking_color
\ No newline at end of file
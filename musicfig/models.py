@@ -1,6 +1,22 @@
 import json
 
 from . import db
+from sqlalchemy import orm
+
+try:
+    import orjson
+
+    def dump_json(obj):
+        # json turns non-string keys (e.g. ints in yaml attributes) into strings; so must we
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    load_json = orjson.loads
+except ImportError:
+    def dump_json(obj):
+        # compact, to match what orjson produces
+        return json.dumps(obj, separators=(",", ":"))
+
+    load_json = json.loads
 
 class Song(db.Model):
     __tablename__ = "songs"
@@ -20,7 +36,19 @@ class NFCTagModel(db.Model):
     description = db.Column(db.Text, nullable=True)
     type = db.Column(db.String(20), nullable=True)
     attr = db.Column(db.Text, nullable=False)
-    last_updated = db.Column(db.Integer)
+    last_updated = db.Column(db.Integer, index=True)
+
+    @orm.reconstructor
+    def _init_on_load(self):
+        self._attr_source = None
+        self._attr_object = None
 
     def get_attr_object(self):
-        return json.loads(self.attr)
\ No newline at end of file
+        """
+        Decodes the json `attr` column. The result is kept around for as long as
+        `attr` doesn't change, so repeat calls don't re-parse
+        """
+        if getattr(self, "_attr_source", None) is not self.attr:
+            self._attr_object = load_json(self.attr or "{}")
+            self._attr_source = self.attr
+        return self._attr_object
\ No newline at end of file
@@ -1,15 +1,29 @@
-import json
+import itertools
 import logging
 import os
+import stat
+import sys
+import threading
 import time
 import yaml
 
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from .socketio import socketio
-from .models import db, NFCTagModel
+from .models import db, dump_json, NFCTagModel
 from flask import current_app
 from musicfig import colors
-from sqlalchemy import func
+from sqlalchemy import delete, func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from types import MappingProxyType
+
+try:
+    # libyaml-backed loader; much faster, but only present if pyyaml was built against libyaml
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +34,24 @@ class NFCTagOperationError(BaseException):
     pass
 
 class NFCTag():
+    __slots__ = ("identifier", "name", "description", "attributes")
+
+    # shared by every tag rather than looked up for each one
+    logger = logging.getLogger("musicfig")
+
+    required_attributes = ()
+    _required_attribute_set = frozenset()
+    _friendly_name = "nfc"
+    _attributes_description = "{}"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # resolved once per class so verifying a tag is a single set operation and
+        # the names are plain attribute reads
+        cls._required_attribute_set = frozenset(cls.required_attributes)
+        cls._friendly_name = cls.__name__[0:-3].lower()
+        cls._attributes_description = cls._build_attributes_description()
+
     @classmethod
     def get_friendly_name(cls):
         """
@@ -28,37 +60,45 @@ class NFCTag():
         Brittle because it assumes the class name ends in "Tag"
 
         Override if not working
+
+        The name is worked out once, when the class is created
         """
-        return cls.__name__[0:-3].lower()
-    
-    @classmethod
-    def _get_required_attributes(cls):
-        return cls.required_attributes if hasattr(cls, 'required_attributes') else []
+        return cls._friendly_name
     
     @classmethod
     def get_attributes_description(cls):
-        json_content = ",".join(['"%s": "..."' % att for att in cls._get_required_attributes()])
+        """ Describes the attributes this type of tag takes; built once, when the class is created """
+        return cls._attributes_description
+
+    @classmethod
+    def _build_attributes_description(cls):
+        """
+        Builds the text returned by `get_attributes_description`
+
+        Override to describe the attributes in more detail
+        """
+        json_content = ",".join(['"%s": "..."' % att for att in cls.required_attributes])
         return "{%s}" % json_content
 
-    def __init__(self, identifier, name=None, description=None, attributes={}, **kwargs):
+    def __init__(self, identifier, name=None, description=None, attributes=None):
         self.identifier = identifier
         self.name = name
         self.description = description
-        self.attributes = attributes
-        self.logger = logging.getLogger("musicfig")
+        self.attributes = {} if attributes is None else attributes
         self._init_attributes()
     
     def _init_attributes(self):
         self._verify_attributes()
 
     def _verify_attributes(self):
-        # unclear if this will work...
-        for required_attribute in self._get_required_attributes():
-            if required_attribute not in self.attributes:
-                raise KeyError("missing required key '%s'" % required_attribute)
+        if not self._required_attribute_set:
+            return
+        missing = self._required_attribute_set.difference(self.attributes)
+        if missing:
+            raise KeyError("missing required key '%s'" % "', '".join(sorted(missing)))
     
     def get_type(self):
-        return self.__class__.__name__.lower().replace("Tag", "")
+        return self.get_friendly_name()
 
     def on_add(self):
         pass
@@ -80,12 +120,7 @@ class UnregisteredTag(NFCTag):
     """
     This is used for tags which have not been added to the database
     """
-    def on_add(self):
-        super().on_add()
-        # should _probably_ use a logger which is associated with the
-        # app, but this is fine for now. Maybe
-        logger.info('Discovered new tag: %s' % self.identifier)
-        socketio.emit("new_tag", {"tag_id": self.identifier})
+    __slots__ = ()
 
     def get_pad_color(self):
         return colors.RED
@@ -96,6 +131,7 @@ class UnknownTypeTag(NFCTag):
     This is used in cases where tags are persisted to the database but then a plugin is removed
     or unregistered; those orphan tags will be represented by this type
     """
+    __slots__ = ()
 
     def get_pad_color(self):
         return colors.RED
@@ -105,16 +141,21 @@ class UnknownTypeTag(NFCTag):
 
 
 class NFCTagStore():
-    tag_cache = {}
+    # dialect name -> insert statement; built once per dialect so SQLAlchemy can reuse
+    # the compiled statement for every import
+    _upsert_statements = {}
+
+    # how many rows go into each executemany when importing
+    INSERT_BATCH_SIZE = 1000
 
     @staticmethod
     def get_last_updated_time():
-        latest_nfc_tag = NFCTagModel.query.order_by(NFCTagModel.last_updated.desc()).first()
-        return 0 if latest_nfc_tag is None else latest_nfc_tag.last_updated
+        last_updated = db.session.query(func.max(NFCTagModel.last_updated)).scalar()
+        return 0 if last_updated is None else last_updated
 
     @staticmethod
     def get_number_of_nfc_tags():
-        return db.session.query(func.count(NFCTagModel.id))
+        return db.session.query(func.count(NFCTagModel.id)).scalar()
 
     @staticmethod
     def populate_from_dict(nfc_tag_dict):
@@ -129,26 +170,57 @@ class NFCTagStore():
         Everything that is remaining will be encoded as json and stored in 
         the `attr` field
         """
-        before = NFCTagStore.get_number_of_nfc_tags()
         def convert_one(k, v, curtime):
             id = k
-            # these double-pops actually pull both of the keys from the dictionary;
-            # this is intentional as we don't want them to stick around afterward
-            name = v.pop("name", v.pop("_name", None))
-            desc = v.pop("description", v.pop("desc", None))
+            # both spellings get pulled from the dictionary, as we don't want either to
+            # stick around in the attributes; the second pop wins if both are present
+            name = v.pop("_name", None)
+            name = v.pop("name", name)
+            desc = v.pop("desc", None)
+            desc = v.pop("description", desc)
             nfc_tag_type = v.pop("type", None)
-            attr = json.dumps(v)
-            return NFCTagModel(id=id, name=name, description=desc,
+            attr = dump_json(v)
+            return dict(id=id, name=name, description=desc,
                 type=nfc_tag_type, attr=attr, last_updated=curtime)
 
         cur_time = NFCTagStore.get_current_timestamp()
-        for k, v in nfc_tag_dict.items():
-            nfc_tag_model = convert_one(k, v, cur_time)
-            db.session.add(nfc_tag_model)
+        # plain mappings skip building (and tracking) an ORM object per row and go out
+        # as executemany batches, all in one transaction; batching keeps the number of
+        # converted rows held at once bounded for big files
+        rows = (convert_one(k, v, cur_time) for k, v in nfc_tag_dict.items())
+        while True:
+            batch = list(itertools.islice(rows, NFCTagStore.INSERT_BATCH_SIZE))
+            if not batch:
+                break
+            db.session.execute(NFCTagStore._get_upsert_statement(), batch)
         db.session.commit()
 
-        after = NFCTagStore.get_number_of_nfc_tags()
-        logger.info("added %s tags; before: %s, after: %s", len(nfc_tag_dict.items()), before, after)
+        logger.info("added %s tags", len(nfc_tag_dict))
+
+    @staticmethod
+    def _get_upsert_statement():
+        """
+        Builds the statement for writing imported tags. Where the database supports it,
+        this is an upsert, so re-importing an edited file replaces the existing rows
+        rather than failing on duplicate ids. Other databases get a plain insert.
+        """
+        dialect_name = db.engine.dialect.name
+        statement = NFCTagStore._upsert_statements.get(dialect_name)
+        if statement is not None:
+            return statement
+
+        table = NFCTagModel.__table__
+        dialect_insert = {"sqlite": sqlite_insert, "postgresql": postgresql_insert}.get(dialect_name)
+        if dialect_insert is None:
+            statement = table.insert()
+        else:
+            statement = dialect_insert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.id],
+                set_={column.name: statement.excluded[column.name]
+                      for column in table.columns if column.name != "id"})
+        NFCTagStore._upsert_statements[dialect_name] = statement
+        return statement
 
     @staticmethod
     def get_current_timestamp():
@@ -160,14 +232,28 @@ class NFCTagStore():
 
     @staticmethod    
     def get_nfc_tag_by_id(id):
-        return NFCTagModel.query.filter(NFCTagModel.id == id).first()
+        # goes through the session's identity map first, so a row which is already
+        # loaded doesn't cost another query
+        return db.session.get(NFCTagModel, id)
+
+    @staticmethod
+    def get_nfc_tags_by_ids(ids):
+        """
+        Fetches all of the nfc tags with the given identifiers in a single query
+
+        Identifiers without a matching record are simply absent from the result
+        """
+        ids = list(ids)
+        if not ids:
+            return []
+        return NFCTagModel.query.filter(NFCTagModel.id.in_(ids)).all()
 
     @staticmethod
     def delete_nfc_tag_by_id(id):
-        to_delete = NFCTagModel.query.filter(NFCTagModel.id == id).first()
-        db.session.delete(to_delete)
+        # straight to a DELETE; there's no need to load the row first
+        result = db.session.execute(delete(NFCTagModel).where(NFCTagModel.id == id))
         db.session.commit()
-        return True
+        return result.rowcount > 0
     
     @staticmethod
     def create_nfc_tag(id, type, name=None, description=None, attributes=None):
@@ -180,30 +266,50 @@ class NFCTagStore():
 
 class NFCTagManager():
     # todo; merge this class with NFCTagStore
+
+    # how many unregistered tags to hang on to; anything waved at the pad can end up
+    # in there, so it needs a limit
+    MAX_UNREGISTERED_TAGS = 512
+
     def __init__(self):
         self.nfc_tags_file = current_app.config.get("NFC_TAG_FILE")
-        self.last_updated = -1
         self.tags = {}
-        self._tags = {}
+        self.unregistered_tags = OrderedDict()
+        self._last_file_stat = None
+
+        # set whenever `self.tags` is fully loaded; cleared while an import is running
+        self.tags_ready = threading.Event()
+        # a single worker so imports queue up behind each other rather than racing
+        self._import_executor = ThreadPoolExecutor(max_workers=1)
 
         if self.should_import_file():
-            self.import_file()
+            self.import_file_in_background()
+        else:
+            self.prefetch_all()
+            self.tags_ready.set()
 
     instance = None
+    _instance_lock = threading.Lock()
 
     @classmethod
     def get_instance(cls):
+        # double-checked so the common case doesn't take the lock, but two threads
+        # racing on first access can't both build (and import the tag file)
         if cls.instance is None:
-            cls.instance = NFCTagManager()
+            with cls._instance_lock:
+                if cls.instance is None:
+                    cls.instance = NFCTagManager()
         return cls.instance
     
     TAG_REGISTRY_MAP = {}
+    _TAG_REGISTRY_VIEW = MappingProxyType(TAG_REGISTRY_MAP)
     
     @classmethod
     def register_tag_type(cls, nfc_tag_class):
         if not issubclass(nfc_tag_class, NFCTag):
             raise TypeError("`nfc_tag_class` must be a class object which extends NFCTag")
-        cls.TAG_REGISTRY_MAP[nfc_tag_class.get_friendly_name()] = nfc_tag_class
+        # interned so lookups with an interned type string match on identity
+        cls.TAG_REGISTRY_MAP[sys.intern(nfc_tag_class.get_friendly_name())] = nfc_tag_class
     
     @classmethod
     def get_tag_class_from_tag_type(cls, nfc_tag_type: str):
@@ -214,9 +320,9 @@ class NFCTagManager():
         """
         Fetches a dictionary of all the registered tag types in the format `type_str` -> `type_class_obj`
 
-        Note 
+        The mapping is a read-only view; use `register_tag_type` to add to it
         """
-        return cls.TAG_REGISTRY_MAP
+        return cls._TAG_REGISTRY_VIEW
 
     def should_import_file(self):
         """
@@ -227,25 +333,67 @@ class NFCTagManager():
         *** note, this is destructive in nature; yaml will completely overwrite
         the database ***
         """
-        if not os.path.isfile(self.nfc_tags_file):
+        try:
+            file_stat = os.stat(self.nfc_tags_file)
+        except OSError:
             return False
+        if not stat.S_ISREG(file_stat.st_mode):
+            return False
+
+        # nothing has changed since the last time we looked, so whatever we decided
+        # then (importing or not) still holds
+        file_signature = (file_stat.st_mtime_ns, file_stat.st_size)
+        if file_signature == self._last_file_stat:
+            return False
+        self._last_file_stat = file_signature
+
         last_db_update = NFCTagStore.get_last_updated_time()
-        last_file_update = int(os.stat(self.nfc_tags_file).st_mtime)
+        last_file_update = int(file_stat.st_mtime)
         logger.info("last db updated: %s, last file updated: %s", last_db_update, last_file_update)
         return last_file_update > last_db_update
     
 
     def import_file(self):
         with open(self.nfc_tags_file, 'r') as f:
-            nfc_tag_defs = yaml.load(f, Loader=yaml.FullLoader)
+            nfc_tag_defs = yaml.load(f, Loader=YamlLoader)
         NFCTagStore.populate_from_dict(nfc_tag_defs)
 
+        # whatever was cached may well have just been replaced
+        self.tags.clear()
+        self.unregistered_tags.clear()
+        self.prefetch_all()
+
+
+    def import_file_in_background(self):
+        """
+        Runs `import_file` on the import worker so the caller isn't held up parsing the
+        file and writing the database. Tag lookups wait until the import is done.
+
+        Returns:
+        Future for the import
+        """
+        app = current_app._get_current_object()
+        self.tags_ready.clear()
+
+        def do_import():
+            try:
+                with app.app_context():
+                    self.import_file()
+            except Exception:
+                logger.exception("failed importing nfc tag file %s", self.nfc_tags_file)
+            finally:
+                self.tags_ready.set()
+
+        return self._import_executor.submit(do_import)
+
 
-    def nfc_tag_from_model(self, nfc_tag_model):
+    def nfc_tag_from_model(self, nfc_tag_model, nfc_tag_class=None):
         # TODO build a composite tag in case we want to do e.g. spotify + webhook;
         # perhaps do a list of types or something?
 
-        nfc_tag_class = NFCTagManager.get_tag_class_from_tag_type(nfc_tag_model.type)
+        # callers which have already resolved the class can pass it in to skip the lookup
+        if nfc_tag_class is None:
+            nfc_tag_class = NFCTagManager.get_tag_class_from_tag_type(nfc_tag_model.type)
         return nfc_tag_class(nfc_tag_model.id,
                              name=nfc_tag_model.name,
                              description=nfc_tag_model.description,
@@ -253,31 +401,76 @@ class NFCTagManager():
                              )
 
 
+    def prefetch(self, ids):
+        """
+        Builds and caches the tags for all of the given identifiers using a single
+        query rather than one query per identifier. Identifiers which aren't in the
+        database are left alone; they'll be handled on lookup.
+        """
+        to_fetch = [id for id in ids if id not in self.tags]
+        for nfc_tag_model in NFCTagStore.get_nfc_tags_by_ids(to_fetch):
+            self._cache_tag_from_model(nfc_tag_model)
+
+
+    def prefetch_all(self):
+        """
+        Builds and caches every tag in the database in one pass
+        """
+        for nfc_tag_model in NFCTagStore.get_all_nfc_tags():
+            self._cache_tag_from_model(nfc_tag_model)
+
+
+    def _cache_tag_from_model(self, nfc_tag_model):
+        """
+        Builds and caches the tag for a single row. A row which can't be built (e.g. it's
+        missing a required attribute or its attributes aren't valid json) is logged and
+        cached as an UnknownTypeTag, so one bad row doesn't take the rest down with it.
+        """
+        try:
+            nfc_tag = self.nfc_tag_from_model(nfc_tag_model)
+        except Exception as e:
+            logger.exception("could not build tag %s of type %s: %s", nfc_tag_model.id, nfc_tag_model.type, e)
+            nfc_tag = UnknownTypeTag(nfc_tag_model.id,
+                                     name=nfc_tag_model.name,
+                                     description=nfc_tag_model.description)
+        self.tags[nfc_tag_model.id] = nfc_tag
+
+
     def get_nfc_tag_by_id(self, id):
         """
-        Looks everywhere for a tag which is registered. Will return either
-        old-style or new-style tags, depending on which store it comes from.
-        New style will override old style
+        Looks up a registered tag. All persisted tags are loaded when the manager
+        is built (or once its background import finishes) and kept current by
+        `create_nfc_tag` and `delete_nfc_tag_by_id`, so this never needs to go to
+        the database; anything not found is an unregistered tag.
         """
-        if id not in self.tags:
-            nfc_tag_model = NFCTagStore.get_nfc_tag_by_id(id)
-            
-            if nfc_tag_model is None:
-                nfc_tag = UnregisteredTag(id)
-            else:
-                nfc_tag = self.nfc_tag_from_model(nfc_tag_model)
-            logger.debug("built tag of type %s from info %s", type(nfc_tag), nfc_tag_model)
-            self.tags[id] = nfc_tag
-        return self.tags.get(id)
+        # a tag which is scanned while the file is still being imported shouldn't be
+        # mistaken for an unregistered one
+        self.tags_ready.wait()
+
+        nfc_tag = self.tags.get(id)
+        if nfc_tag is not None:
+            return nfc_tag
+
+        # unregistered tags are kept in a separate, bounded LRU so the same tag being
+        # scanned over and over is still the same object, without letting every stray
+        # tag live forever
+        nfc_tag = self.unregistered_tags.get(id)
+        if nfc_tag is None:
+            nfc_tag = UnregisteredTag(id)
+            logger.debug("built unregistered tag for id %s", id)
+            self.unregistered_tags[id] = nfc_tag
+            if len(self.unregistered_tags) > NFCTagManager.MAX_UNREGISTERED_TAGS:
+                self.unregistered_tags.popitem(last=False)
+        else:
+            self.unregistered_tags.move_to_end(id)
+        return nfc_tag
     
 
     def delete_nfc_tag_by_id(self, id):
         if id is None:
             return
-        try:
-            self.tags.pop(id)
-        except Exception:
-            pass
+        self.tags.pop(id, None)
+        self.unregistered_tags.pop(id, None)
         success = NFCTagStore.delete_nfc_tag_by_id(id)
         socketio.emit("tag_deleted", {"tag_id": id})
     
@@ -285,13 +478,15 @@ class NFCTagManager():
     def create_nfc_tag(self, id, tag_type, name=None, description=None, attributes=None):
         if id is None or tag_type is None:
             raise ValueError("must include both id and tag_type")
-        if NFCTagManager.get_tag_class_from_tag_type(tag_type) is UnknownTypeTag:
+        nfc_tag_class = NFCTagManager.get_tag_class_from_tag_type(tag_type)
+        if nfc_tag_class is UnknownTypeTag:
             raise ValueError("tag_type was %s, must be one of the following: [%s]",
                                 tag_type, "],[".join(NFCTagManager.get_registered_tag_types().keys()))
         if isinstance(attributes, dict):
-            attributes = json.dumps(dict)
+            attributes = dump_json(attributes)
 
         model_obj = NFCTagStore.create_nfc_tag(id, tag_type, name, description, attributes)
-        nfc_tag = self.nfc_tag_from_model(model_obj)
+        nfc_tag = self.nfc_tag_from_model(model_obj, nfc_tag_class)
+        self.unregistered_tags.pop(id, None)
         self.tags[id] = nfc_tag
         return nfc_tag
\ No newline at end of file
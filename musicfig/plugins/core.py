@@ -3,15 +3,75 @@ The plugins contained herein are part of the core functionality
 of the application. It will still work without them, but these
 provide added creature comforts and are included separately.
 """
+import threading
+
+from concurrent.futures import Future
 from .. import colors
 from ..nfc_tag import UnregisteredTag, NFCTag, NFCTagOperationError, NFCTagManager
+from ..dispatcher import dispatcher, TagAddedEvent, TagRemovedEvent, AddErrorEvent, AddSuccessEvent, \
+                         RemoveSuccessEvent, RemoveErrorEvent, ProcessingStartedEvent
 from ..lego import DimensionsTagEvent
 from ..socketio import socketio
-from pubsub import pub
 
 class PluginError(BaseException):
     pass
 
+class Batcher:
+    """
+    Collects items into batches and hands each batch over in one go
+
+    Items are grouped by a key of the caller's choosing. A batch is handed over once it
+    has been waiting `delay_s`, or as soon as it holds `max_size` items, whichever comes
+    first. The callback runs on the timer's thread, or on the caller's thread when a
+    batch fills up, and never while the lock is held.
+    """
+    def __init__(self, flush, delay_s, max_size):
+        """
+        Positional arguments:
+        flush -- callable taking (key, list of items) for each batch being handed over
+        delay_s -- longest a batch waits before it's handed over, in seconds
+        max_size -- number of items which makes a batch go out straight away
+        """
+        self._flush = flush
+        self._delay_s = delay_s
+        self._max_size = max_size
+        self._batches = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, key, item):
+        """
+        Adds an item to the batch for the given key
+
+        Positional arguments:
+        key -- hashable key the batch is grouped by
+        item -- whatever the flush callback expects
+        """
+        with self._lock:
+            batch = self._batches.setdefault(key, [])
+            batch.append(item)
+            if len(batch) >= self._max_size:
+                del self._batches[key]
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self._delay_s, self._flush_all)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if batch is not None:
+            self._flush(key, batch)
+
+    def _flush_all(self):
+        """ Hands over every batch which is waiting """
+        with self._lock:
+            batches = self._batches
+            self._batches = {}
+            self._timer = None
+
+        for key, batch in batches.items():
+            self._flush(key, batch)
+
 class BasePlugin:
     """
     Base class for implementing plugins
@@ -25,8 +85,8 @@ class BasePlugin:
       upon. These will be concrete classes of type nfc_tag.NFCTag and should be defined
       in the custom plugin module. Defining this will filter the tag events which come
       in to only those pertaining to this type of NFCTag
-    - Subscribe and respond to tag add and tag removed topics
-    - Publish events for the following upon handling the add/remove topics:
+    - Subscribe and respond to tag added and tag removed events
+    - Publish events for the following upon handling the add/remove events:
       - add succeeded
       - add failed - this is accomplished by raising NFCTagOperationError in the handler
       - remove succeeded
@@ -38,14 +98,24 @@ class BasePlugin:
     but one _could_ do it.
     """
 
+    TAG_CLASS = None
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Checks the plugin's TAG_CLASS when the plugin class is defined, so a bad one
+        fails at import rather than whenever the plugin happens to be instantiated
+        """
+        super().__init_subclass__(**kwargs)
+        tag_class = cls.TAG_CLASS
+        if tag_class is not None and not (isinstance(tag_class, type) and issubclass(tag_class, NFCTag)):
+            raise ValueError("if defined, `TAG_CLASS` must extend nfc_tag.NFCTag")
+
     def __init__(self):
         """
         Base initializer which must be overridden for proper functioning
         """
-        tag_class = getattr(self, "TAG_CLASS") if hasattr(self, "TAG_CLASS") else None
-        if tag_class is not None and not issubclass(tag_class, NFCTag):
-            raise ValueError("if defined, `tag_class` must extend nfc_tag.NFCTag")
-        self.tag_class = tag_class
+        self.tag_class = self.TAG_CLASS
+        self._listeners_registered = False
 
     def init_app(self, app):
         """
@@ -61,7 +131,13 @@ class BasePlugin:
         """
         self.app = app
         self.logger = app.logger
-        self.register_event_listeners()
+        self._publish = dispatcher.publish
+        self._success_pad_color = self._get_success_pad_color()
+        # init_app can run more than once for the same plugin (e.g. under the reloader);
+        # subscribing again would have every handler fire once per call
+        if not self._listeners_registered:
+            self.register_event_listeners()
+            self._listeners_registered = True
         self.register_tag_class()
     
     def _get_from_config_or_fail(self, config_key):
@@ -84,11 +160,12 @@ class BasePlugin:
         """
         Registers event listeners to connect with the rest of the app
 
-        By default, we'll listen to all tag.added and tag.removed events', however if 
+        By default, we'll listen to all TagAddedEvent and TagRemovedEvent events for tags of
+        this plugin's tag class (or for every tag, if there is no tag class), however if 
         listening to events is not your jam, feel free to override this method.
         """
-        pub.subscribe(self.on_tag_added, "tag.added")
-        pub.subscribe(self.on_tag_removed, "tag.removed")
+        dispatcher.subscribe(TagAddedEvent, self.on_tag_added, tag_class=self.tag_class)
+        dispatcher.subscribe(TagRemovedEvent, self.on_tag_removed, tag_class=self.tag_class)
 
     def register_tag_class(self):
         """
@@ -113,8 +190,8 @@ class BasePlugin:
         not be overridden. To customize what happens when a tag event comes in, customize
         `_on_tag_added` instead.
 
-        If a tag type is registered, this method will filter out any events without that tag
-        type before passing it into the logic handler.
+        If a tag type is registered, this method is only subscribed to events for tags of that
+        type, so it never sees events for other tags.
 
         If the logic handler raises an NFCTagOperationError, it will be caught and dispatch
         an error event; otherwise it will dispatch a success event.
@@ -135,8 +212,8 @@ class BasePlugin:
         not be overridden. To customize what happens when a tag event comes in, customize
         `_on_tag_removed` instead.
 
-        If a tag type is registered, this method will filter out any events without that tag
-        type before passing it into the logic handler.
+        If a tag type is registered, this method is only subscribed to events for tags of that
+        type, so it never sees events for other tags.
 
         If the logic handler raises an NFCTagOperationError, it will be caught and dispatch
         an error event; otherwise it will dispatch a success event.
@@ -167,16 +244,25 @@ class BasePlugin:
         success_event_dispatcher -- callable for dispatching a success event
         error_event_dispatcher -- callable for dispatching an error event
         """
-        if not isinstance(nfc_tag, self.tag_class):
-            return
-
         self.dispatch_start_handling_event(tag_event)
         
         try:
-            work_operation(tag_event, nfc_tag)
+            result = work_operation(tag_event, nfc_tag)
         except NFCTagOperationError as e:
             self.logger.exception("%s failed; tag_event: %s, nfc_tag: %s", work_operation.__name__, tag_event, nfc_tag)
             error_event_dispatcher(tag_event)
+            return
+
+        if isinstance(result, Future):
+            # the work is still running elsewhere; report on it once it's done
+            def on_done(future):
+                if future.exception() is not None:
+                    self.logger.error("%s failed; tag_event: %s, nfc_tag: %s", work_operation.__name__, tag_event, nfc_tag,
+                                      exc_info=future.exception())
+                    error_event_dispatcher(tag_event)
+                else:
+                    success_event_dispatcher(tag_event)
+            result.add_done_callback(on_done)
         else:
             success_event_dispatcher(tag_event)
 
@@ -194,11 +280,13 @@ class BasePlugin:
         get into this method. 
 
         If this method raises an NFCTagOperationError, an error event will be dispatched; else
-        a success event will be dispatched
+        a success event will be dispatched. Long-running work can instead be handed off and its
+        concurrent.futures.Future returned, in which case the success or error event is
+        dispatched once that future completes (an error if it raised anything).
 
         -- CAUTION --
         As with any Observer system, the event which is passed in here does not stop here; it
-        will go to any listeners on this topic. Thus there are two _very important_ things to
+        will go to any listeners for this event. Thus there are two _very important_ things to
         keep in mind.
         
         First, do not depend upon the event handlers being triggered in any particular
@@ -224,11 +312,13 @@ class BasePlugin:
         get into this method. 
 
         If this method raises an NFCTagOperationError, an error event will be dispatched; else
-        a success event will be dispatched
+        a success event will be dispatched. Long-running work can instead be handed off and its
+        concurrent.futures.Future returned, in which case the success or error event is
+        dispatched once that future completes (an error if it raised anything).
 
         -- CAUTION --
         As with any Observer system, the event which is passed in here does not stop here; it
-        will go to any listeners on this topic. Thus there are two _very important_ things to
+        will go to any listeners for this event. Thus there are two _very important_ things to
         keep in mind.
         
         First, do not depend upon the event handlers being triggered in any particular
@@ -255,7 +345,7 @@ class BasePlugin:
         Positional arguments:
         tag_event -- DimensionsTagEvent the event which triggered the failure 
         """
-        pub.sendMessage("handler_response.add.error", tag_event=tag_event)
+        self._publish(AddErrorEvent(tag_event))
     
     def dispatch_add_success_event(self, tag_event: DimensionsTagEvent):
         """
@@ -264,7 +354,7 @@ class BasePlugin:
         Positional arguments:
         tag_event -- DimensionsTagEvent the event which triggered the success
         """
-        pub.sendMessage("handler_response.add.success", tag_event=tag_event, color=self._get_success_pad_color())
+        self._publish(AddSuccessEvent(tag_event, self._success_pad_color))
     
     def dispatch_remove_success_event(self, tag_event:DimensionsTagEvent):
         """
@@ -273,7 +363,7 @@ class BasePlugin:
         Positional arguments:
         tag_event -- DimensionsTagEvent the event which triggered the failure 
         """
-        pub.sendMessage("handler_response.remove.success", tag_event=tag_event)
+        self._publish(RemoveSuccessEvent(tag_event))
     
     def dispatch_remove_error_event(self, tag_event:DimensionsTagEvent):
         """
@@ -282,7 +372,7 @@ class BasePlugin:
         Positional arguments:
         tag_event -- DimensionsTagEvent the event which triggered the failure 
         """
-        pub.sendMessage("handler_response.remove.error", tag_event=tag_event)
+        self._publish(RemoveErrorEvent(tag_event))
     
     def dispatch_start_handling_event(self, tag_event:DimensionsTagEvent):
         """
@@ -291,7 +381,7 @@ class BasePlugin:
         Positional arguments:
         tag_event -- DimensionsTagEvent the event which is being handled
         """
-        pub.sendMessage("handler_response.processing_started", tag_event=tag_event, color=self._get_success_pad_color())
+        self._publish(ProcessingStartedEvent(tag_event, self._success_pad_color))
 
 
 class UnregisteredTagPlugin(BasePlugin):
@@ -301,13 +391,34 @@ class UnregisteredTagPlugin(BasePlugin):
     """
 
     TAG_CLASS = UnregisteredTag
+
+    # new tags are sent to the browser in batches; a batch goes out this long after
+    # its first tag, or as soon as it's this big, whichever comes first
+    NEW_TAG_FLUSH_DELAY_S = 0.05
+    MAX_NEW_TAG_BATCH_SIZE = 8
+
+    def __init__(self):
+        super().__init__()
+        self._new_tags = Batcher(self._send_new_tags, UnregisteredTagPlugin.NEW_TAG_FLUSH_DELAY_S,
+                                 UnregisteredTagPlugin.MAX_NEW_TAG_BATCH_SIZE)
     
     def _on_tag_added(self, tag_event: DimensionsTagEvent, nfc_tag: NFCTag):
 
         # should _probably_ use a logger which is associated with the
         # app, but this is fine for now. Maybe
-        self.logger.info('Discovered new tag: %s' % tag_event.identifier)
-        socketio.emit("new_tag", {"tag_id": tag_event.identifier})
+        self.logger.info('Discovered new tag: %s', tag_event.identifier)
+        self._new_tags.add(None, tag_event.identifier)
+
+    def _send_new_tags(self, key, tag_ids):
+        """
+        Sends a batch of new tags to the browser
+
+        Positional arguments:
+        key -- unused; all new tags go in the same batch
+        tag_ids -- identifiers of the unregistered tags, in the order they were found
+        """
+        # a tag put down more than once in a batch only needs announcing once
+        socketio.emit("new_tags", {"tag_ids": list(dict.fromkeys(tag_ids))})
 
     def _get_success_pad_color(self):
         return colors.YELLOW
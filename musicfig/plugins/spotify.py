@@ -1,6 +1,9 @@
+import functools
 import json
+import os
+import threading
+import time
 import tekore as tk
-import unidecode
 
 
 from .core import BasePlugin
@@ -8,14 +11,17 @@ from .. import colors
 from ..lego import Dimensions
 from ..models import db, Song
 from ..nfc_tag import NFCTag, NFCTagOperationError
-from collections import namedtuple
-from pubsub import pub
+from collections import OrderedDict
+from concurrent.futures import Future
+from enum import Enum
 from tekore._convert import to_uri
 from tekore._error import HTTPError
+from unidecode import unidecode
 
-ONE_MINUTE_IN_MS = 60 * 1000 # 60 seconds
+CIRCLE_PAD = Dimensions.CIRCLE_PAD
 
-SpotifyClientConfig = namedtuple("SpotifyClientConfig", ["client_id", "client_secret", "redirect_uri"])
+SPOTIFY_URI_PREFIX = "spotify:"
+DEFAULT_TOKEN_FILE = os.path.join(os.path.expanduser("~"), ".musicfig", "spotify_tokens.json")
 
 # A brief note. We're going hard on all audio being played through Spotify; in fact, we're
 # going to not support playing through any other means. There is a fairly large refactor
@@ -45,11 +51,48 @@ SpotifyClientConfig = namedtuple("SpotifyClientConfig", ["client_id", "client_se
 # but not today
 
 
+def parse_spotify_uri(spotify_uri):
+    """
+    Splits a tag's spotify uri into its media type and id
+
+    Takes both the short form used in tag attributes ("track:<id>") and the full form
+    Spotify hands out ("spotify:track:<id>"). The id comes back empty if there isn't one.
+
+    Positional arguments:
+    spotify_uri -- the uri to split
+    """
+    if spotify_uri.startswith(SPOTIFY_URI_PREFIX):
+        spotify_uri = spotify_uri[len(SPOTIFY_URI_PREFIX):]
+    media_type, _, media_id = spotify_uri.partition(":")
+    return media_type, media_id
+
+
+@functools.lru_cache(maxsize=4096)
+def _transliterate(text):
+    """
+    ASCII-only version of the given text; names recur a lot, so results are remembered
+
+    Positional arguments:
+    text -- string to transliterate
+    """
+    if text.isascii():
+        return text
+    return unidecode(text)
+
+
+class PlaybackState(Enum):
+    IDLE = 0     # nothing started from a tag
+    PLAYING = 1  # playing the resource from a tag
+    PAUSED = 2   # paused after that tag was removed
+
+
 class SpotifyTag(NFCTag):
-    required_attributes = ["spotify_uri"]
+    __slots__ = ("spotify_uri", "media_type", "media_id", "start_position_ms")
+
+    required_attributes = ("spotify_uri",)
 
     @classmethod
-    def get_attributes_description(cls):
+    def _build_attributes_description(cls):
         return json.dumps({
             "spotify_uri": '[Required] uri for the spotify resource; starts with "track", "album", etc',
             "start_position_ms": '[Optional] offset from the beginning of the song to start playing; only works for songs. Default is 0'
@@ -58,32 +101,81 @@ class SpotifyTag(NFCTag):
     def _init_attributes(self):
         super()._init_attributes()
         self.spotify_uri = self.attributes["spotify_uri"]
+        self.media_type, self.media_id = parse_spotify_uri(self.spotify_uri)
+        if not self.media_id:
+            self.logger.warning("invalid spotify_uri [%s] on tag %s; it won't play", self.spotify_uri, self.identifier)
+        start_position_ms = self.attributes.get("start_position_ms")
+        self.start_position_ms = 0 if start_position_ms is None else self._parse_ms(start_position_ms)
+
+    @classmethod
+    def _parse_ms(cls, value):
+        """
+        Converts a configured millisecond value into an int, falling back to 0 if it isn't one
+
+        Positional arguments:
+        value -- the value from the tag's attributes
+        """
+        if type(value) is int:
+            return value
         try:
-            self.start_position_ms = int(self.attributes.get("start_position_ms", 0))
-        except ValueError as e:
-            self.logger.warning("invalid value [%s] found in start position config")
-            self.start_position_ms = 0
+            return int(value)
+        except (TypeError, ValueError):
+            cls.logger.warning("invalid value [%s] found in start position config", value)
+            return 0
 
 
 class SpotifyPlugin(BasePlugin):
 
     TAG_CLASS = SpotifyTag
+    MAX_CACHED_SONGS = 512
+
+    # how long to wait for a tag to settle before acting on it; taps and wiggles on
+    # the pad come through as quick add/remove bursts and only the last one matters
+    PLAYBACK_SETTLE_TIME_S = 0.15
+
+    # refresh tokens this long before they actually expire, so a token which is about to
+    # run out is never the one sent along with a playback request
+    TOKEN_REFRESH_MARGIN_S = 120
 
     def __init__(self):
         super().__init__()
         self.current_user_id = None
         self.user_token_map = {"local": None} # `local` is apparently a special user with no token; keep it
+        self.client_id = None
         self.credentials = None
         self.client = None
-        self.active_tag = None
-        self.paused_tag = None
+        # (PlaybackState, SpotifyTag or None), always replaced as a whole
+        self.playback = (PlaybackState.IDLE, None)
+        self._song_cache = OrderedDict()
+        # songs are looked up from request threads as well as playback; guards `_song_cache`
+        self._song_cache_lock = threading.Lock()
+        self._pending_playback = None
+        self._playback_timer = None
+        self._playback_lock = threading.Lock()
+        # held while a start/pause is being carried out, so they happen one at a time
+        self._playback_apply_lock = threading.Lock()
+
+        # derived from the fields above by `_update_current_user_state`; kept so the
+        # playback operations can check whether they can go ahead without redoing it
+        self._ready = False
+        self._current_token = None
+        self._current_token_refresh_at = 0
+
+        # user id -> refresh token saved by a previous run, for users who haven't needed
+        # their token yet this run
+        self._saved_refresh_tokens = {}
+        self.persist_tokens = False
+        self.token_file = None
+        # held while the token file is written, so two writers can't mix their content
+        self._save_lock = threading.Lock()
+
+        # user id -> Future for a token refresh or restore which is underway
+        self._refresh_inflight = {}
+        self._refresh_lock = threading.Lock()
 
     ###############################
     # configuration, setup, initialization, registration operations
     ###############################
-    def _app_config_to_client_config(self, app_config):
-        return SpotifyClientConfig(app_config.get("CLIENT_ID"), app_config.get("CLIENT_SECRET"), app_config.get("REDIRECT_URI"))
-
     def init_app(self, app):
         super().init_app(app)
 
@@ -93,10 +185,17 @@ class SpotifyPlugin(BasePlugin):
         self.credentials = tk.Credentials(self.client_id, self.client_secret, self.redirect_uri)
         self.client = tk.Spotify()
 
+        # remember refresh tokens between runs so a restart doesn't need a fresh login
+        self.persist_tokens = app.config.get("SPOTIFY_PERSIST_TOKENS", True)
+        self.token_file = app.config.get("SPOTIFY_TOKEN_FILE", DEFAULT_TOKEN_FILE)
+        if self.persist_tokens:
+            self._load_saved_tokens()
+        self._update_current_user_state()
+
         self.logger.info('To activate Spotify visit: %s' % self.redirect_uri.replace('callback',''))
 
     def get_client_id(self):
-        return self.credentials.client_id
+        return self.client_id
 
     def get_authorization_url(self):
         return self.credentials.user_authorisation_url(scope=tk.scope.every)
@@ -113,22 +212,88 @@ class SpotifyPlugin(BasePlugin):
     def get_current_user_id(self):
         return self.current_user_id
 
-    def get_current_user_token(self, refresh=False):
-        token = self.user_token_map.get(self.current_user_id)
+    def get_current_user_token(self, refresh=True):
+        token = self._current_token
         if token is None:
-            return token
+            token = self._restore_saved_token(self.current_user_id)
+            if token is None:
+                return token
+
+        if refresh and time.time() >= self._current_token_refresh_at:
+            token = self._refresh_user_token(self.current_user_id, token)
+        return token
+
+    def _refresh_user_token(self, user_id, token):
+        """
+        Refreshes a user's token and stores the new one
+
+        If another thread is already refreshing (or restoring) the same user's token, waits
+        for that and returns its result instead of asking Spotify a second time.
 
-        if token.is_expiring and refresh:
+        Positional arguments:
+        user_id -- the user the token belongs to
+        token -- the token to refresh
+        """
+        def refresh():
             try:
-                token = self.credentials.refresh(token)
+                new_token = self.credentials.refresh(token)
             except HTTPError as e:
                 self.logger.exception("failed refreshing token: %s", str(e))
-            self.user_token_map[self.current_user_id] = token
+                new_token = token
+            self.user_token_map[user_id] = new_token
+            self._update_current_user_state()
+            self._save_tokens()
+            return new_token
+        return self._update_token_once(user_id, refresh)
+
+    def _update_token_once(self, user_id, operation):
+        """
+        Runs an operation which gets a user a new token, unless one is already underway for
+        that user, in which case this waits for it and returns its result instead
+
+        Positional arguments:
+        user_id -- the user the token belongs to
+        operation -- callable taking no arguments and returning the new token
+        """
+        with self._refresh_lock:
+            future = self._refresh_inflight.get(user_id)
+            is_updating_thread = future is None
+            if is_updating_thread:
+                future = self._refresh_inflight[user_id] = Future()
+        if not is_updating_thread:
+            return future.result()
+
+        try:
+            token = operation()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(token)
+        finally:
+            with self._refresh_lock:
+                self._refresh_inflight.pop(user_id, None)
         return token
     
     def set_current_user_id(self, user):
+        changed = user != self.current_user_id
         self.current_user_id = user
+        self._update_current_user_state()
+        if changed:
+            self._save_tokens()
         self.logger.debug(self.current_user_id)
+
+    def _update_current_user_state(self):
+        """
+        Recomputes the cached token, its refresh time, and whether playback can go ahead
+
+        Must be called whenever the current user, the credentials, or the current user's
+        token changes.
+        """
+        token = self.user_token_map.get(self.current_user_id)
+        self._current_token = token
+        self._current_token_refresh_at = 0 if token is None else token.expires_at - SpotifyPlugin.TOKEN_REFRESH_MARGIN_S
+        self._ready = token is not None and self.is_activated()
     
     def get_user_token_for_code(self, code):
         return self.credentials.request_user_token(code)
@@ -137,18 +302,104 @@ class SpotifyPlugin(BasePlugin):
         with self.client.token_as(token):
             user = self.client.current_user()
         self.user_token_map[user.id] = token
+        self._saved_refresh_tokens.pop(user.id, None)
+        self._update_current_user_state()
+        self._save_tokens()
         return user
-    
-    def _get_token_and_verify_active(self):
-        if not self.is_activated():
+
+    def _load_saved_tokens(self):
+        """
+        Reads the refresh tokens, and which user was current, saved by a previous run
+
+        The tokens themselves are only exchanged for access tokens when first needed.
+        """
+        try:
+            with open(self.token_file) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
             return
-        
-        token = self.get_current_user_token()
-        if token is None:
-            self.logger.error("No Spotify token found")
+        except (OSError, ValueError) as e:
+            self.logger.warning("could not read saved spotify tokens from %s: %s", self.token_file, str(e))
             return
 
-        return token 
+        self._saved_refresh_tokens = dict(saved.get("refresh_tokens", {}))
+        if self.current_user_id is None:
+            self.current_user_id = saved.get("current_user_id")
+
+    def _restore_saved_token(self, user_id):
+        """
+        Exchanges a user's refresh token saved by a previous run for a new token
+
+        Each saved token is only tried once; if it no longer works, the user has to log in again.
+        Callers which come in while it's being tried wait for the outcome, like they do for
+        a refresh.
+
+        Positional arguments:
+        user_id -- the user to restore the token for
+
+        Returns:
+        the new token, or None if there was no saved token or it couldn't be used
+        """
+        def restore():
+            refresh_token = self._saved_refresh_tokens.pop(user_id, None)
+            if refresh_token is None:
+                # nothing saved, or another thread restored it just before we got here
+                return self.user_token_map.get(user_id)
+
+            try:
+                token = self.credentials.refresh_user_token(refresh_token)
+            except HTTPError as e:
+                self.logger.exception("failed restoring saved token for %s: %s", user_id, str(e))
+                self._save_tokens()
+                return None
+
+            self.user_token_map[user_id] = token
+            self._update_current_user_state()
+            self._save_tokens()
+            return token
+        return self._update_token_once(user_id, restore)
+
+    def _save_tokens(self):
+        """
+        Writes every known refresh token, plus the current user, to the token file
+
+        The file is only ever readable by the owner, and is replaced in one step so a
+        crash part way through can't leave a half-written file behind. Writers take turns,
+        so they can't mix their content in the temp file, and each writes what's current
+        once it gets its turn.
+        """
+        if not self.persist_tokens:
+            return
+
+        with self._save_lock:
+            refresh_tokens = dict(self._saved_refresh_tokens)
+            refresh_tokens.update((user_id, token.refresh_token) for user_id, token in list(self.user_token_map.items())
+                                  if token is not None and token.refresh_token is not None)
+            content = json.dumps({"current_user_id": self.current_user_id, "refresh_tokens": refresh_tokens})
+
+            tmp_file = self.token_file + ".tmp"
+            try:
+                token_dir = os.path.dirname(self.token_file)
+                if token_dir:
+                    os.makedirs(token_dir, mode=0o700, exist_ok=True)
+                fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w") as f:
+                    f.write(content)
+                os.replace(tmp_file, self.token_file)
+            except OSError as e:
+                self.logger.warning("could not save spotify tokens to %s: %s", self.token_file, str(e))
+    
+    def _get_token_and_verify_active(self):
+        if self._ready:
+            return self.get_current_user_token(refresh=True)
+
+        if self.is_activated():
+            # there may be a token saved by a previous run which just hasn't been used yet
+            token = self.get_current_user_token(refresh=True)
+            if token is not None:
+                return token
+            self.logger.error("No Spotify token found")
+        return None 
     
     ###############################
     # Object operations
@@ -157,27 +408,64 @@ class SpotifyPlugin(BasePlugin):
     def _get_song_from_track(self, track):
         """
         This mainly converts the Track object into a Song object, caching if necessary
+
+        The same track comes back on every playback poll for as long as it's playing, so
+        songs are kept in a small in-memory LRU in front of the database. Cached songs are
+        detached from the session so they stay readable from any thread or request.
         """
-        try:
-            song = Song.query.filter(Song.id == track.id).first()
-        except Exception as e:
-            self.logger.exception("Song query failed: %s", str(e))
-            song = None
-        
+        song = self._get_known_song(track.id)
         if song is None:
             song = self._create_song_object_from_track(track)
+            self._cache_song(song)
+        return song
+        
+    def _get_known_song(self, track_id):
+        """
+        Fetches a song we've already stored, without asking Spotify about it
 
+        Positional arguments:
+        track_id -- Spotify id of the track
+
+        Returns:
+        the Song, or None if it has never been stored
+        """
+        with self._song_cache_lock:
+            song = self._song_cache.get(track_id)
+            if song is not None:
+                self._song_cache.move_to_end(track_id)
+                return song
+
+        try:
+            song = db.session.get(Song, track_id)
+        except Exception as e:
+            self.logger.exception("Song query failed: %s", str(e))
+            return None
+        if song is not None:
+            db.session.expunge(song)
+            self._cache_song(song)
         return song
         
     def _create_song_object_from_track(self, track):
         image_url = track.album.images[0].url # get the first image from the list of potentials
-        name = unidecode.unidecode(track.name)
+        name = _transliterate(track.name)
         duration_ms = track.duration_ms
-        artist = ",".join([unidecode.unidecode(a.name) for a in track.artists])
+        # transliterate the joined names in one go; "," comes through unchanged
+        artist = _transliterate(",".join(a.name for a in track.artists))
         song = Song(id=track.id, image_url=image_url, artist=artist, name=name, duration_ms=duration_ms)
         db.session.add(song)
+        db.session.flush()
+        # detach before committing so the commit doesn't expire the fields we just set
+        db.session.expunge(song)
         db.session.commit()
+        with self._song_cache_lock:
+            self._song_cache.pop(song.id, None)
         return song
+
+    def _cache_song(self, song):
+        with self._song_cache_lock:
+            self._song_cache[song.id] = song
+            if len(self._song_cache) > SpotifyPlugin.MAX_CACHED_SONGS:
+                self._song_cache.popitem(last=False)
     
     ###############################
     # Playback operations
@@ -201,7 +489,7 @@ class SpotifyPlugin(BasePlugin):
         if currently_playing is None or not currently_playing.is_playing:
             return None
 
-        return currently_playing if currently_playing is not None and currently_playing.is_playing else None
+        return currently_playing
 
     def pause(self):
         token = self._get_token_and_verify_active()
@@ -219,26 +507,28 @@ class SpotifyPlugin(BasePlugin):
         if token is None:
             return
         
-        ms_remaining_in_song = ONE_MINUTE_IN_MS
         with self.client.token_as(token):
             try:
                 self.client.playback_resume()
-                song, currently_playing = self.get_currently_playing()
-                ms_remaining_in_song = song.duration_ms - currently_playing.progress_ms
             except HTTPError as e:
                 self.logger.exception("Failed resuming playback: %s", str(e))
-
-        return ms_remaining_in_song
     
-    def spotcast(self, spotify_uri, position_ms=0):
+    def spotcast(self, spotify_uri, position_ms=0, media_type=None, media_id=None):
         """
-        Returns the duration in ms... or at least, attempts to. If it's not a song,
-        just returns one minute
+        Starts playing the given resource; that's a single round trip to Spotify, nothing
+        is looked up about it afterwards
+
+        The uri is split into its media type and id here unless those are passed in
+        already split (as they are for tags, which split their uri once when loaded).
         """
         token = self._get_token_and_verify_active()
         if token is None:
             return
-        media_type, media_id = spotify_uri.split(":")
+        if media_id is None:
+            media_type, media_id = parse_spotify_uri(spotify_uri)
+        if not media_id:
+            self.logger.error("Invalid spotify uri: %s", spotify_uri)
+            return
         with self.client.token_as(token):
             try:
                 if media_type == "track":
@@ -248,39 +538,97 @@ class SpotifyPlugin(BasePlugin):
                 self.logger.info("started playing media identified by %s", spotify_uri)
             except HTTPError as e:
                 self.logger.exception("Failed spotcast with uri: %s due to error: %s", spotify_uri, str(e))
-                return
-        
-        if media_type != "track":
-            return ONE_MINUTE_IN_MS
-        
-        song, _ = self.get_currently_playing()
-        if song is None:
-            return ONE_MINUTE_IN_MS
-
-        return song.duration_ms
     
     def start_playback_from_tag(self, nfc_tag: SpotifyTag) -> int:
         """
         Begins playing the Spotify resource identified by the given tag
         """
-        if nfc_tag is self.paused_tag:
+        state, current_tag = self.playback
+        if state is PlaybackState.PAUSED and current_tag is nfc_tag:
             self.resume()
         else:
-            self.spotcast(nfc_tag.spotify_uri, nfc_tag.start_position_ms)
-            self.paused_tag = None
-        self.active_tag = nfc_tag
+            self.spotcast(nfc_tag.spotify_uri, nfc_tag.start_position_ms,
+                          media_type=nfc_tag.media_type, media_id=nfc_tag.media_id)
+        self.playback = (PlaybackState.PLAYING, nfc_tag)
     
     def pause_playback_from_tag(self, nfc_tag: SpotifyTag) -> int:
-        if nfc_tag is not self.active_tag:
-            self.logger.warning("tag mismatch with active tag; given: %s vs active: %s", nfc_tag, self.active_tag)
-        
-        if self.active_tag is None:
-            self.paused_tag = None
-        else:
-            self.pause()
-            self.paused_tag = self.active_tag
-            self.active_tag = None
+        state, current_tag = self.playback
+        if state is not PlaybackState.PLAYING:
+            # nothing playing to pause; leave a paused tag paused so it can still be resumed
+            self.logger.debug("nothing playing to pause for tag %s; state: %s", nfc_tag, state)
+            return
+
+        if nfc_tag is not current_tag:
+            self.logger.warning("tag mismatch with active tag; given: %s vs active: %s", nfc_tag, current_tag)
+        self.pause()
+        self.playback = (PlaybackState.PAUSED, current_tag)
     
+    def _schedule_playback(self, nfc_tag: SpotifyTag, should_play: bool):
+        """
+        Queues up starting or pausing playback for the given tag
+
+        Every call restarts the settle timer and replaces whatever was queued before, so a
+        burst of add/remove events ends up as a single call for whichever came last.
+
+        Positional arguments:
+        nfc_tag -- the tag the event was for
+        should_play -- True to start playback from the tag, False to pause it
+
+        Returns:
+        Future which completes once the burst this event belongs to has been carried out;
+        it holds the exception if that failed
+        """
+        future = Future()
+        with self._playback_lock:
+            # the queued events are superseded and share the outcome of this one; they're kept
+            # in the order they came in so their pad colors get applied in that order too
+            futures = [future] if self._pending_playback is None else self._pending_playback[2] + [future]
+            self._pending_playback = (nfc_tag, should_play, futures)
+            if self._playback_timer is not None:
+                self._playback_timer.cancel()
+            self._playback_timer = threading.Timer(SpotifyPlugin.PLAYBACK_SETTLE_TIME_S, self._apply_pending_playback)
+            self._playback_timer.daemon = True
+            self._playback_timer.start()
+        return future
+
+    def _apply_pending_playback(self):
+        """
+        Starts or pauses playback for the last queued tag, unless that's already the state we're in
+
+        Only one start/pause is carried out at a time; a timer which fires while another is
+        still talking to Spotify waits for it, so it always sees the state that one left.
+        """
+        with self._playback_apply_lock:
+            with self._playback_lock:
+                pending = self._pending_playback
+                self._pending_playback = None
+            if pending is None:
+                # a later timer already picked this up
+                return
+
+            nfc_tag, should_play, futures = pending
+            error = None
+            state, current_tag = self.playback
+            if should_play and state is PlaybackState.PLAYING and current_tag is nfc_tag:
+                pass # removed and put back before the pause went out; it's still playing
+            elif not should_play and state is not PlaybackState.PLAYING:
+                pass # put down and taken off again before it started; nothing to pause
+            else:
+                with self.app.app_context():
+                    try:
+                        if should_play:
+                            self.start_playback_from_tag(nfc_tag)
+                        else:
+                            self.pause_playback_from_tag(nfc_tag)
+                    except Exception as e:
+                        error = e
+
+        for future in futures:
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
     ###############################
     # Event Listeners
     ###############################
@@ -288,21 +636,15 @@ class SpotifyPlugin(BasePlugin):
         """
         What to do when a tag event we're subscribed to comes in
         """
-        if tag_event.pad_num != Dimensions.CIRCLE_PAD:
+        if tag_event.pad_num != CIRCLE_PAD:
             raise NFCTagOperationError("Music tags only work on the circle pad")
         
-        try:
-            self.start_playback_from_tag(nfc_tag)
-        except Exception as e:
-            raise NFCTagOperationError("Encountered exception (%s) starting spotify: %s", e.__name__, str(e))
+        return self._schedule_playback(nfc_tag, True)
 
     def _on_tag_removed(self, tag_event, nfc_tag: NFCTag):
         """
         What to do when a tag event we're subscribed to comes in
         """
-        try:
-            self.pause_playback_from_tag(nfc_tag)
-        except Exception as e:
-            raise NFCTagOperationError("Encountered exception (%s) pausing spotify: %s", e.__name__, str(e))
+        return self._schedule_playback(nfc_tag, False)
 
 spotify_client = SpotifyPlugin()
\ No newline at end of file
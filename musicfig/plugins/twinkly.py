@@ -1,5 +1,9 @@
+import functools
 import json
+import mmap
 import os
+import stat
+import threading
 import time
 import xled
 
@@ -7,12 +11,24 @@ from .core import BasePlugin
 from ..lego import DimensionsTagEvent
 from ..nfc_tag import NFCTag, NFCTagOperationError
 
+
+@functools.lru_cache(maxsize=4)
+def _get_control_interface(ip_address, mac_address):
+    """
+    Builds the control interface for the device at the given address, reusing
+    a previously built one if we've already seen this device
+    """
+    return xled.ControlInterface(ip_address, mac_address)
+
+
 class TwinklyTag(NFCTag):
-    required_attributes = ["pattern"]
+    __slots__ = ("pattern", "fps", "ms_per_frame")
+
+    required_attributes = ("pattern",)
     DEFAULT_FPS = 30
 
     @classmethod
-    def get_attributes_description(cls):
+    def _build_attributes_description(cls):
         return json.dumps({
             "pattern": "[Required] name of the pattern file to load, excluding the path",
             "fps": "[Optional] how many frames per second the pattern should play at (default is 30)"
@@ -23,18 +39,21 @@ class TwinklyTag(NFCTag):
         self.pattern = self.attributes["pattern"]
         try:
             self.fps = int(self.attributes.get("fps", TwinklyTag.DEFAULT_FPS))
+            if self.fps <= 0:
+                raise ValueError("fps must be positive")
         except ValueError as e:
-            self.logger.warning("bad value in 'fps' attribute on '%s': [%s]; number expected", self.pattern, self.attributes.get("fps"))
+            self.logger.warning("bad value in 'fps' attribute on '%s': [%s]; positive number expected", self.pattern, self.attributes.get("fps"))
             self.fps = TwinklyTag.DEFAULT_FPS
+        self.ms_per_frame = 1000 // self.fps
         
     def get_ms_per_frame(self):
         """
         Fetches the number of frames per second converted to the number of milliseconds per frame
 
         Returns:
-        int-cast number of ms per frame (e.g. 33 instead of 33.333333 for fps of 30)
+        int number of ms per frame, rounded down (e.g. 33 instead of 33.333333 for fps of 30)
         """
-        return int(1000 / self.fps)
+        return self.ms_per_frame
 
 
 class TwinklyPlugin(BasePlugin):
@@ -56,7 +75,27 @@ class TwinklyPlugin(BasePlugin):
         self.pattern_dir = self._get_from_config_or_fail("TWINKLY_PATTERN_DIR")
         self.ip_address = self._get_from_config_or_fail("TWINKLY_IP_ADDRESS")
         self.mac_address = self._get_from_config_or_fail("TWINKLY_MAC_ADDRESS")
-        self.control_interface = xled.ControlInterface(self.ip_address, self.mac_address)
+        self.control_interface = _get_control_interface(self.ip_address, self.mac_address)
+
+        # operation name -> bound method on the control interface
+        self._operations = {}
+
+        # the number of LEDs is fixed for a device, so it's only asked for once
+        self.num_leds = None
+
+        # pattern file -> (file signature, num_frames)
+        self.pattern_info = {}
+
+        # file signature of the movie which was last uploaded to the device. This is only
+        # what we did, not what the device says; anything else driving the device (the
+        # Twinkly app, a power cycle) can replace its movie without us knowing. It's
+        # forgotten whenever talking to the device fails, and checked against the device's
+        # movie config before an upload is skipped (see `_device_has_pattern`)
+        self.loaded_pattern = None
+
+        # talk to the device once up front, so the first tag doesn't have to wait on (or be
+        # the first to find out about) an unreachable device
+        threading.Thread(target=self._probe_device, name="twinkly-probe", daemon=True).start()
     
 
     ###############################
@@ -80,58 +119,136 @@ class TwinklyPlugin(BasePlugin):
         """
         self.logger.debug("Twinkly - requested pattern %s", twinkly_tag.pattern)
 
-        pattern_file = self._get_file_path_for_pattern(twinkly_tag.pattern)
-        if pattern_file is None:
-            return
-
         # we'll need these for calculations
-        try:
-            num_leds = int(self._try_network_operation('get_device_info', verify_keys=["number_of_led"])["number_of_led"])
-        except ValueError as e:
-            self.logger.exception("bad value for number_of_led")
-            raise NFCTagOperationError("bad value for number_of_led")
-            
-        bytes_per_frame = num_leds * 3
-
-        # do the tree
-        self._try_network_operation("set_mode", call_args=["off"])
-        with open(pattern_file, 'rb') as f:
-            response = self._try_network_operation("set_led_movie_full", call_args=[f])
-
-            # also need the size of the file
-            num_frames = response.data.get("frames_number")
+        num_leds = self._get_num_leds()
 
-        # calc num frames
-        if num_frames is None:
-            file_size = os.path.getsize(pattern_file)
-            num_frames = int(file_size / bytes_per_frame)
+        pattern_info = self._get_pattern_info(twinkly_tag.pattern, num_leds)
+        if pattern_info is None:
+            return
+        pattern_file, pattern_signature, num_frames = pattern_info
 
-        call_args = [twinkly_tag.get_ms_per_frame(), num_frames, num_leds]
+        # do the tree
+        if not self._device_has_pattern(pattern_signature, num_frames):
+            self.loaded_pattern = None
+            self._try_network_operation("set_mode", call_args=("off",))
+            with open(pattern_file, 'rb') as f:
+                # hand over a read-only memory map rather than the file object so the upload
+                # is streamed straight out of the page cache instead of being copied into a
+                # python buffer first
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as movie:
+                    # it's read front to back exactly once, so let the kernel read ahead
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        movie.madvise(mmap.MADV_SEQUENTIAL)
+                    response = self._try_network_operation("set_led_movie_full", call_args=(movie,))
+
+            # the device's own count wins over ours
+            num_frames = response.data.get("frames_number") or num_frames
+            self.pattern_info[pattern_file] = (pattern_signature, num_frames)
+            self.loaded_pattern = pattern_signature
+        # else the device still holds this movie (as far as it can tell us); all it needs is (re)configuring
+
+        call_args = (twinkly_tag.ms_per_frame, num_frames, num_leds)
         self._try_network_operation("set_led_movie_config", call_args=call_args)
-        self._try_network_operation("set_mode", call_args=["movie"])
+        self._try_network_operation("set_mode", call_args=("movie",))
 
     
     ###############################
     # Utility
     ###############################
-    def _get_file_path_for_pattern(self, pattern):
+    def _probe_device(self):
+        """
+        Checks the device can be reached, picking up its number of LEDs along the way
         """
-        Fetches the file path in which the requested pattern _should_ exist.
+        try:
+            self._get_num_leds()
+        except NFCTagOperationError as e:
+            self.logger.warning("Twinkly device at %s could not be reached: %s", self.ip_address, str(e))
+        else:
+            self.logger.info("Twinkly device at %s reports %s LEDs", self.ip_address, self.num_leds)
+
+    def _device_has_pattern(self, pattern_signature, num_frames):
+        """
+        Checks whether the movie last uploaded is the given pattern and the device still holds it
+
+        The device can't tell us which movie it holds, only how many frames it's got, so a
+        different movie of the same length uploaded by something else goes unnoticed.
+
+        Positional arguments:
+        pattern_signature -- file signature of the pattern from `_get_pattern_info`
+        num_frames -- int number of frames in the pattern
+
+        Returns:
+        True if the upload can be skipped, False if the pattern needs uploading
+        """
+        if self.loaded_pattern != pattern_signature:
+            return False
+        try:
+            movie_config = self._try_network_operation("get_led_movie_config", verify_keys=("frames_number",))
+        except NFCTagOperationError as e:
+            self.logger.warning("could not check the movie on the device; uploading again: %s", str(e))
+            return False
+        if movie_config["frames_number"] != num_frames:
+            self.logger.info("movie on the device has changed; uploading again")
+            self.loaded_pattern = None
+            return False
+        return True
+
+    def _get_num_leds(self):
+        """
+        Fetches the number of LEDs on the device, asking the device only the first time
+
+        Returns:
+        int number of LEDs
+
+        Raises NFCTagOperationError if the device can't be reached or gives back garbage
+        """
+        if self.num_leds is None:
+            try:
+                self.num_leds = int(self._try_network_operation('get_device_info', verify_keys=("number_of_led",))["number_of_led"])
+            except ValueError as e:
+                self.logger.exception("bad value for number_of_led")
+                raise NFCTagOperationError("bad value for number_of_led")
+        return self.num_leds
+
+    def _get_pattern_info(self, pattern, num_leds):
+        """
+        Fetches the file for the requested pattern along with how many frames it holds.
+
+        The frame count falls right out of the file size, so there's no need to wait on
+        the device to tell us. It's remembered per file until the file changes, so repeat
+        plays of a pattern cost a single stat.
 
         Positional arguments:
         pattern -- string name of the pattern
+        num_leds -- int number of LEDs on the device
 
         Returns:
-        string file path if the pattern file exists, None otherwise
+        (file path, file signature, number of frames) if the pattern file exists and has
+        content, None otherwise
         """
         pattern_file = os.path.join(self.pattern_dir, pattern)
-        if not os.path.isfile(pattern_file):
+        try:
+            pattern_stat = os.stat(pattern_file)
+        except OSError:
+            pattern_stat = None
+        if pattern_stat is None or not stat.S_ISREG(pattern_stat.st_mode):
             self.logger.warning("Requested pattern %s does not exist at %s", pattern, pattern_file)
             return None
-        return pattern_file
+        if pattern_stat.st_size == 0:
+            self.logger.warning("Requested pattern %s is empty", pattern)
+            return None
+
+        pattern_signature = (pattern_file, pattern_stat.st_mtime_ns, pattern_stat.st_size, num_leds)
+        cached = self.pattern_info.get(pattern_file)
+        if cached is not None and cached[0] == pattern_signature:
+            return pattern_file, pattern_signature, cached[1]
+
+        num_frames = int(pattern_stat.st_size / (num_leds * 3))
+        self.pattern_info[pattern_file] = (pattern_signature, num_frames)
+        return pattern_file, pattern_signature, num_frames
     
 
-    def _try_network_operation(self, operation, call_args=[], verify_keys=[]):
+    def _try_network_operation(self, operation, call_args=(), verify_keys=()):
         """
         Wraps network operations in order to better handle failures along the way
 
@@ -144,8 +261,8 @@ class TwinklyPlugin(BasePlugin):
         operation -- name of the API method we are going to execute
 
         Keyword args:
-        call_args: string list of the arguments to be passed to the API
-        verify_keys: string list of keys which must be in a successful response
+        call_args: sequence of the arguments to be passed to the API
+        verify_keys: sequence of string keys which must be in a successful response
 
         Return:
         Varies, but generally a dict which contains a property called "code" which
@@ -153,7 +270,9 @@ class TwinklyPlugin(BasePlugin):
         a None response.
         """
         start = time.time()
-        func = getattr(self.control_interface, operation)
+        func = self._operations.get(operation)
+        if func is None:
+            func = self._operations[operation] = getattr(self.control_interface, operation)
         try:
             response = func(*call_args)
         except Exception as e:
@@ -169,18 +288,20 @@ class TwinklyPlugin(BasePlugin):
             addl_info["code"] = response.get("code")
             addl_info["response"] = response
         else:
-            for k in verify_keys:
-                if response.get(k) is None:
-                    error = "Twinkly API call response did not contain required key"
-                    addl_info["key"] = k
-                    addl_info["response"] = response
+            missing_key = next((k for k in verify_keys if response.get(k) is None), None)
+            if missing_key is not None:
+                error = "Twinkly API call response did not contain required key"
+                addl_info["key"] = missing_key
+                addl_info["response"] = response
         
         if error is not None:
+            # whatever happened, we can no longer be sure what movie the device holds
+            self.loaded_pattern = None
             msg = error + "; extra information: " + ", ".join(["%s=%s" % (k, v) for k, v in addl_info.items()])
             raise NFCTagOperationError(msg)
 
         end = time.time()
-        self.logger.info("operation %s took %s ms", operation, int((end - start) * 1000))
+        self.logger.debug("operation %s took %s ms", operation, int((end - start) * 1000))
         return response
 
 
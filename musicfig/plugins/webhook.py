@@ -1,8 +1,9 @@
 import json
 
-from .core import BasePlugin
+from concurrent.futures import Future, ThreadPoolExecutor
+from .core import BasePlugin, Batcher
 from ..lego import DimensionsTagEvent
-from ..nfc_tag import NFCTag, NFCTagOperationError
+from ..nfc_tag import NFCTag
 from ..webhook import PostMixin
 
 
@@ -14,15 +15,18 @@ class WebhookTag(NFCTag, PostMixin):
     Included in the core because webhooks are super common, so this can be a good starting point
     for anything which needs this functionality
     """
-    required_attributes = ["added_url"]
+    __slots__ = ("added_url", "added_post_json", "removed_url", "removed_post_json", "batch")
+
+    required_attributes = ("added_url",)
 
     @classmethod
-    def get_attributes_description(cls):
+    def _build_attributes_description(cls):
         return json.dumps({
             "added_url": "[Required] The url to call when the tag is added",
             "added_post_json": "[Optional] JSON payload to send to the added url call. Default is empty string",
             "removed_url": "[Optional] The url to call when the tag is removed",
-            "removed_post_json": "[Optional] JSON payload to send with the removed url call. Only used when there is a removed_url defined. Default is empty string"
+            "removed_post_json": "[Optional] JSON payload to send with the removed url call. Only used when there is a removed_url defined. Default is empty string",
+            "batch": '[Optional] if true, calls to the same url made close together are combined into one call with a payload of {"events": [{"tag": <tag id>, "payload": <post json>}, ...]}. Default is false'
         }, indent=4)
 
     def _init_attributes(self):
@@ -31,26 +35,74 @@ class WebhookTag(NFCTag, PostMixin):
         self.added_post_json = self.attributes.get("added_post_json")
         self.removed_url = self.attributes.get("removed_url")
         self.removed_post_json = self.attributes.get("removed.post_json")
+        self.batch = self.attributes.get("batch") is True
 
 
 class WebhookPlugin(BasePlugin, PostMixin):
 
     TAG_CLASS = WebhookTag
+
+    # calls from batching tags go out this long after the first one is queued, or as soon
+    # as this many are waiting for the same url, whichever comes first
+    BATCH_INTERVAL_S = 0.05
+    MAX_BATCH_SIZE = 10
+
+    def __init__(self):
+        super().__init__()
+        # a single worker so hooks go out in the order the tags were scanned
+        self._post_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="webhook")
+
+        # (event, Future) waiting to be sent together, batched by url
+        self._batches = Batcher(self._submit_batch, WebhookPlugin.BATCH_INTERVAL_S, WebhookPlugin.MAX_BATCH_SIZE)
     
     def _on_tag_added(self, tag_event: DimensionsTagEvent, nfc_tag: NFCTag):
-        try:
-            self.post_json(nfc_tag.added_url, nfc_tag.added_post_json)
-        except Exception as e:
-            raise NFCTagOperationError("Got exception (%s) calling add post hook: %s", e.__name__, str(e))
+        return self._post(nfc_tag, nfc_tag.added_url, nfc_tag.added_post_json)
 
     
     def _on_tag_removed(self, tag_event: DimensionsTagEvent, nfc_tag: NFCTag):
         if nfc_tag.removed_url is None:
             return
         
+        return self._post(nfc_tag, nfc_tag.removed_url, nfc_tag.removed_post_json)
+
+    def _post(self, nfc_tag: WebhookTag, url, payload):
+        """
+        Sends the payload to the url in the background, batching it if the tag asks for that
+
+        Positional arguments:
+        nfc_tag -- the tag the call is for
+        url -- string url to post to
+        payload -- json content to post
+
+        Returns:
+        Future which completes once the call has been made
+        """
+        if not nfc_tag.batch:
+            return self._post_executor.submit(self.post_json, url, payload)
+
+        future = Future()
+        self._batches.add(url, ({"tag": nfc_tag.identifier, "payload": payload}, future))
+        return future
+
+    def _submit_batch(self, url, batch):
+        """ Hands a batch which is ready to go to the post worker """
+        self._post_executor.submit(self._post_batch, url, batch)
+
+    def _post_batch(self, url, batch):
+        """
+        Posts a batch of events in one call and completes each event's future with the outcome
+
+        Positional arguments:
+        url -- string url to post to
+        batch -- list of (event, Future)
+        """
         try:
-            self.post_json(nfc_tag.removed_url, nfc_tag.removed_post_json)
+            self.post_json(url, {"events": [event for event, _ in batch]})
         except Exception as e:
-            raise NFCTagOperationError("Got exception (%s) calling remove post hook: %s", e.__name__, str(e))
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for _, future in batch:
+                future.set_result(None)
 
 webhook_plugin = WebhookPlugin()
\ No newline at end of file
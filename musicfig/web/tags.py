@@ -3,6 +3,7 @@ from json.decoder import JSONDecodeError
 import logging
 
 from . import web
+from ..dispatcher import dispatcher, TagCreatedEvent
 from ..nfc_tag import NFCTagStore, NFCTagManager
 from flask import \
     redirect, \
@@ -10,7 +11,6 @@ from flask import \
     request, \
     session, \
     url_for
-from pubsub import pub
 
 logger = logging.getLogger(__name__)
 
@@ -64,7 +64,7 @@ def create_tag():
     try:
         nfc_tag = NFCTagManager.get_instance().create_nfc_tag(tag_id, tag_type, name=name, description=description, attributes=attributes)
         session["created_tag_id"] = nfc_tag.identifier
-        pub.sendMessage("tag_created")
+        dispatcher.publish(TagCreatedEvent())
     except Exception as e:
         logger.exception("failed to create tag; found error [%s]", str(e))
         return
@@ -1,6 +1,30 @@
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds for a webhook call
+POST_TIMEOUT = (3.05, 10)
+
+
+def _build_session():
+    """
+    Builds the session all webhook posts go through, so connections to a host are
+    kept alive and reused between calls instead of being set up fresh every time
+    """
+    session = requests.Session()
+    # only connection failures are retried; a POST which reached the server is never resent
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.2))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+_session = _build_session()
+
+
 class PostMixin():
+    __slots__ = ()
+
     def post_json(self, endpoint, message=""):
         """
         Posts the given json message to the given endpoint
@@ -18,14 +42,15 @@ class PostMixin():
         _ideal_, but I haven't tuned it yet; we'll get to that)
         """
         message = "" if message is None else message
-        response = requests.post(
+        response = _session.post(
             endpoint,
             json=message,
-            headers={'Content-Type': 'application/json'}
+            headers={'Content-Type': 'application/json'},
+            timeout=POST_TIMEOUT
         )
         if response.status_code != 200:
             raise ValueError(
                 'Request to %s returned an error %s, the response is:\n%s'
                 % (endpoint, response.status_code, response.text)
             )
-        return response
\ No newline at end of file
+        return response